@@ -1,11 +1,20 @@
 from decimal import Decimal
+import hashlib
+import importlib.util
+import io
 import json
 import logging
-from collections.abc import Generator
-from typing import Optional, Union, cast, Any
-import tiktoken
-
-from openai import OpenAI
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Generator, Mapping
+from functools import cached_property, lru_cache
+from typing import TYPE_CHECKING, Optional, Union, cast, Any
+import httpx
+
+from openai import DefaultHttpxClient, OpenAI
 from openai import Stream
 from openai.types import Completion
 from openai.types.chat import (
@@ -41,18 +50,52 @@ from dify_plugin.entities.model.llm import (
 from dify_plugin.entities.model.message import (
     AssistantPromptMessage,
     AudioPromptMessageContent,
-    ImagePromptMessageContent,
     PromptMessage,
     PromptMessageContentType,
     PromptMessageTool,
     SystemPromptMessage,
-    TextPromptMessageContent,
     ToolPromptMessage,
     UserPromptMessage,
 )
 
+if TYPE_CHECKING:
+    # tiktoken is imported where it is used at runtime
+    import tiktoken
+
+# prefer the C-backed orjson for JSON handling when it is installed
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+
+    def _json_dumps(
+        obj: Any, sort_keys: bool = False, default: Optional[Callable] = None
+    ) -> str:
+        return orjson.dumps(
+            obj, default=default, option=orjson.OPT_SORT_KEYS if sort_keys else None
+        ).decode()
+
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(
+        obj: Any, sort_keys: bool = False, default: Optional[Callable] = None
+    ) -> str:
+        return json.dumps(obj, sort_keys=sort_keys, default=default)
+
+
+# optional Aho-Corasick automaton for matching fine-tuned models to predefined models
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
 logger = logging.getLogger(__name__)
 
+# shared by stream chunks without content, must not be mutated
+_EMPTY_ASSISTANT_MESSAGE = AssistantPromptMessage(content="")
+
 OPENAI_BLOCK_MODE_PROMPT = """You should always follow the instructions and output a valid {{block}} object.
 The structure of the {{block}} object you can found in the instructions, use {"answer": "$your_answer"} as the default structure
 if you are not sure about the structure.
@@ -62,14 +105,690 @@ if you are not sure about the structure.
 </instructions>
 """
 
+# OPENAI_BLOCK_MODE_PROMPT split around the instructions once at import time,
+# with the block placeholder already filled for the supported response formats
+_BLOCK_MODE_PROMPT_HEAD, _BLOCK_MODE_PROMPT_TAIL = OPENAI_BLOCK_MODE_PROMPT.split(
+    "{{instructions}}"
+)
+_BLOCK_MODE_PROMPT_PARTS = {
+    response_format: (
+        _BLOCK_MODE_PROMPT_HEAD.replace("{{block}}", response_format),
+        _BLOCK_MODE_PROMPT_TAIL.replace("{{block}}", response_format),
+    )
+    for response_format in ("JSON", "XML")
+}
+
+
+def _block_mode_prompt(instructions: str, response_format: str) -> str:
+    """
+    Build OPENAI_BLOCK_MODE_PROMPT for the given instructions and response format
+    """
+    parts = _BLOCK_MODE_PROMPT_PARTS.get(response_format)
+    if parts is None:
+        parts = (
+            _BLOCK_MODE_PROMPT_HEAD.replace("{{block}}", response_format),
+            _BLOCK_MODE_PROMPT_TAIL.replace("{{block}}", response_format),
+        )
+
+    # like replacing on the whole template, placeholders in the instructions are filled too
+    head, tail = parts
+    instructions = instructions.replace("{{block}}", response_format)
+    return f"{head}{instructions}{tail}"
+
+
+# models that reject list content once a prompt has more than one user message
+CONTENT_FLATTENING_MODELS = frozenset({"gpt-4-turbo", "gpt-4-turbo-2024-04-09"})
+
 # o1, o3, o4 compatibility
 O_SERIES_COMPATIBILITY = ("o1", "o3", "o4")
 
+# model class flags, see _model_class
+MODEL_CLASS_O_SERIES = 1
+MODEL_CLASS_O3_PRO = 2
+
+_O_SERIES_RE = re.compile("|".join(map(re.escape, O_SERIES_COMPATIBILITY)))
+_O3_PRO_RE = re.compile(r"o3-pro")
+
+
+@lru_cache(maxsize=256)
+def _model_class(model: str) -> int:
+    """
+    Classify a model name into MODEL_CLASS_* flags, cached since the same few names repeat
+
+    :param model: model name
+    :return: bitmask of MODEL_CLASS_* flags
+    """
+    model_class = 0
+    if _O_SERIES_RE.match(model):
+        model_class |= MODEL_CLASS_O_SERIES
+    if _O3_PRO_RE.search(model):
+        model_class |= MODEL_CLASS_O3_PRO
+
+    return model_class
+
+
+def _require_str(value: Any) -> str:
+    """
+    Return value if it is a str, raise TypeError otherwise
+
+    :param value: value to check, usually prompt message content
+    :return: value
+    """
+    if type(value) is str:
+        return value
+
+    raise TypeError(f"expected str, got {type(value).__name__}")
+
+
+# models counted with the gpt-4o tokenizer
+_GPT_4O_TOKENIZER_PREFIXES = (*O_SERIES_COMPATIBILITY, "gpt-4.1", "gpt-4.5")
+
+# (model prefixes, (tokens_per_message, tokens_per_name)), the first match wins
+_MSG_TOKEN_TABLE = (
+    # every message follows <im_start>{role/name}\n{content}<im_end>\n,
+    # if there's a name, the role is omitted
+    ("gpt-3.5-turbo-0301", (4, -1)),
+    (("gpt-3.5-turbo", "gpt-4", *O_SERIES_COMPATIBILITY), (3, 1)),
+)
+
+
+def _message_token_overhead(model: str) -> tuple[int, int]:
+    """
+    Look up the fixed tokens a model adds around every message
+
+    :param model: model name as resolved by _resolve_model
+    :return: tokens_per_message and tokens_per_name
+    """
+    for prefixes, overhead in _MSG_TOKEN_TABLE:
+        if model.startswith(prefixes):
+            return overhead
+
+    raise NotImplementedError(
+        f"get_num_tokens_from_messages() is not presently implemented "
+        f"for model {model}."
+        "See https://platform.openai.com/docs/advanced-usage/managing-tokens for for "
+        "information on how messages are converted to tokens."
+    )
+
+
+def _base_model(model: str) -> str:
+    """
+    Get the base model of a fine-tuned model, e.g. ft:gpt-3.5-turbo-0613:personal::xxxxx
+
+    :param model: model name
+    :return: base model name, or the model itself if it is not fine-tuned
+    """
+    return (
+        model.partition(":")[2].partition(":")[0]
+        if model.startswith("ft:")
+        else model
+    )
+
+
+@lru_cache(maxsize=256)
+def _resolve_model(model: str) -> str:
+    """
+    Resolve the model whose tokenizer is used for token counting
+
+    :param model: model name, fine-tuned names like ft:gpt-4o:org::xxx are accepted
+    :return: model name known to tiktoken
+    """
+    model = _base_model(model)
+
+    # Currently, we can use gpt4o to calculate chatgpt-4o-latest's token.
+    if model == "chatgpt-4o-latest" or model.startswith(_GPT_4O_TOKENIZER_PREFIXES):
+        model = "gpt-4o"
+
+    return model
+
+
+@lru_cache(maxsize=16)
+def _get_encoding_for(model: str) -> "tiktoken.Encoding":
+    """
+    Resolve the tiktoken encoding for a model, cached per model name.
+
+    tiktoken is imported on first use so workers that never count tokens skip loading it.
+
+    :param model: model name
+    :return: encoding, falls back to cl100k_base for unknown models
+    """
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.warning("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# TIKTOKEN_FAST=1 counts tokens with the HuggingFace tokenizers port of the encoding
+# when the package is installed and the tokenizer can be loaded, tiktoken otherwise
+TIKTOKEN_FAST = os.environ.get("TIKTOKEN_FAST") == "1"
+
+# HuggingFace tokenizers equivalent to tiktoken encodings
+_FAST_TOKENIZER_REPOS = {
+    "o200k_base": "Xenova/gpt-4o",
+    "cl100k_base": "Xenova/gpt-4",
+}
+
+
+@lru_cache(maxsize=8)
+def _fast_tokenizer(encoding_name: str) -> Any:
+    """
+    Load the tokenizers backend for a tiktoken encoding, requires tokenizers
+
+    :param encoding_name: tiktoken encoding name
+    :return: tokenizer, or None if there is no equivalent or it can not be loaded
+    """
+    repo = _FAST_TOKENIZER_REPOS.get(encoding_name)
+    if repo is None:
+        return None
+
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        logger.warning("TIKTOKEN_FAST is set but tokenizers is not installed")
+        return None
+
+    try:
+        return Tokenizer.from_pretrained(repo)
+    except Exception:
+        logger.warning(
+            f"Failed to load tokenizer {repo}, falling back to tiktoken", exc_info=True
+        )
+        return None
+
+
+def _encode_lengths(encoding: "tiktoken.Encoding", parts: list[str]) -> list[int]:
+    """
+    Count tokens of every string in parts.
+
+    tiktoken's encode_batch is not used, its thread pool runs on gevent greenlets in the
+    plugin runtime and adds setup cost without parallelism.
+
+    :param encoding: encoding
+    :param parts: strings to encode
+    :return: number of tokens of each string, in order
+    """
+    if TIKTOKEN_FAST:
+        tokenizer = _fast_tokenizer(encoding.name)
+        if tokenizer is not None:
+            return [
+                len(encoded.ids)
+                for encoded in tokenizer.encode_batch(parts, add_special_tokens=False)
+            ]
+
+    encode = encoding.encode
+    return [len(encode(part)) for part in parts]
+
+
+@lru_cache(maxsize=8)
+def _const_key_lens(encoding_name: str) -> dict[str, int]:
+    """
+    Token lengths of the fixed keys of a tool definition, computed once per encoding
+
+    :param encoding_name: tiktoken encoding name
+    :return: number of tokens by key
+    """
+    import tiktoken
+
+    encoding = tiktoken.get_encoding(encoding_name)
+    return {
+        key: len(encoding.encode(key))
+        for key in (
+            "type",
+            "function",
+            "name",
+            "description",
+            "parameters",
+            "properties",
+            "required",
+            "title",
+            "id",
+            "arguments",
+        )
+    }
+
+
+@lru_cache(maxsize=128)
+def _parse_schema(json_schema: str) -> dict:
+    """
+    Parse a json_schema model parameter, cached since apps send the same schema on every call
+
+    :param json_schema: json schema string
+    :return: parsed schema, shared between callers and must not be mutated
+    """
+    return _json_loads(json_schema)
+
+
+@lru_cache(maxsize=8)
+def _predefined_ac(predefined_model_names: tuple[str, ...]) -> Any:
+    """
+    Build an Aho-Corasick automaton over predefined model names, requires pyahocorasick
+
+    :param predefined_model_names: predefined model names in schema order
+    :return: automaton yielding (order, name) for every name found in a string
+    """
+    automaton = ahocorasick.Automaton()
+    for order, predefined_model_name in enumerate(predefined_model_names):
+        automaton.add_word(predefined_model_name, (order, predefined_model_name))
+    automaton.make_automaton()
+
+    return automaton
+
+
+class LRU:
+    """
+    Thread-safe mapping that drops its least recently used entry once it holds more
+    than maxsize entries, on_evict is called with every dropped value
+    """
+
+    def __init__(
+        self, maxsize: int, on_evict: Optional[Callable[[Any], None]] = None
+    ) -> None:
+        self._maxsize = maxsize
+        self._on_evict = on_evict
+        self._entries: OrderedDict[Any, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        """
+        Get the value stored for key, or None
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Any, value: Any) -> None:
+        """
+        Store value for key, evicting the least recently used entry when full
+        """
+        with self._lock:
+            evicted = self._put(key, value)
+        self._evict(evicted)
+
+    def get_or_create(self, key: Any, factory: Callable[[], Any]) -> Any:
+        """
+        Get the value stored for key, or create it with factory while holding the lock
+        """
+        evicted = []
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                value = factory()
+                evicted = self._put(key, value)
+            else:
+                self._entries.move_to_end(key)
+        self._evict(evicted)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            evicted = list(self._entries.values())
+            self._entries.clear()
+        self._evict(evicted)
+
+    def _put(self, key: Any, value: Any) -> list:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._maxsize:
+            return [self._entries.popitem(last=False)[1]]
+        return []
+
+    def _evict(self, values: list) -> None:
+        # called outside the lock, on_evict may block
+        if self._on_evict is not None:
+            for value in values:
+                self._on_evict(value)
+
+
+def _prefix_digest(hasher: "hashlib._Hash") -> str:
+    """
+    Build a token count cache key from the current state of a running hasher
+    """
+    return hasher.hexdigest()[:16]
+
+
+# token counts keyed by a digest of the text prefix they were counted for,
+# chat prompts mostly grow by appending messages, so the count of an already seen
+# prefix of the conversation can be reused and only the new tail has to be encoded
+_prefix_token_cache = LRU(maxsize=4096)
+
+
+# clients are cached per credentials so requests reuse pooled keep-alive connections
+_CLIENT_CACHE_SIZE = 32
+# evicted clients are closed, their http client does not release its pool on its own
+_client_cache = LRU(maxsize=_CLIENT_CACHE_SIZE, on_evict=lambda client: client.close())
+# http2 needs the optional h2 package
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _credentials_cache_key(credentials_kwargs: Mapping) -> tuple:
+    """
+    Build a hashable cache key from client kwargs, unhashable values are serialized
+    """
+    key = []
+    for name, value in sorted(credentials_kwargs.items()):
+        try:
+            hash(value)
+        except TypeError:
+            value = _json_dumps(value, sort_keys=True, default=repr)
+        key.append((name, value))
+
+    return tuple(key)
+
+
+def _env_int(name: str, default: int) -> int:
+    """
+    Read an integer environment variable, malformed values fall back to default
+
+    :param name: environment variable name
+    :param default: value used when the variable is unset or malformed
+    :return: integer value
+    """
+    value = os.environ.get(name)
+    if not value:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"Ignoring {name}={value!r}, expected an integer")
+        return default
+
+
+# coalescing window for streamed text deltas, see _coalesce_stream,
+# off unless OPENAI_STREAM_COALESCE_MAX_MS is set to a positive number of milliseconds
+STREAM_COALESCE_MAX_CHARS = 64
+STREAM_COALESCE_MAX_MS = _env_int("OPENAI_STREAM_COALESCE_MAX_MS", 0)
+
+
+def _coalesce_stream(
+    chunks: Generator[LLMResultChunk, None, None],
+    max_chars: int = STREAM_COALESCE_MAX_CHARS,
+    max_ms: int = STREAM_COALESCE_MAX_MS,
+) -> Generator[LLMResultChunk, None, None]:
+    """
+    Merge consecutive plain text chunks of a stream into fewer, larger chunks.
+
+    Text is buffered until max_chars are collected or max_ms passed since the last
+    yielded chunk. The buffer is only checked when the next upstream chunk arrives,
+    so max_ms is not a deadline: text buffered before the upstream stalls is held
+    until the stall ends. Chunks carrying tool calls, a finish reason or usage are
+    never merged and flush the buffer first. max_ms <= 0 or max_chars <= 1 disables
+    coalescing, which is the default.
+
+    :param chunks: llm response chunk generator
+    :param max_chars: flush once this many characters are buffered
+    :param max_ms: flush once this many milliseconds passed since the last flush
+    :return: llm response chunk generator
+    """
+    if max_ms <= 0 or max_chars <= 1:
+        yield from chunks
+        return
+
+    max_seconds = max_ms / 1000
+    buffer: list[str] = []
+    buffered_chars = 0
+    # metadata of the last buffered chunk, chunk objects themselves are not retained
+    pending: Optional[tuple] = None
+    last_flush = time.monotonic()
+
+    def flush() -> LLMResultChunk:
+        nonlocal buffered_chars, pending, last_flush
+        model, prompt_messages, system_fingerprint, index = pending  # type: ignore
+        merged_chunk = LLMResultChunk(
+            model=model,
+            prompt_messages=prompt_messages,
+            system_fingerprint=system_fingerprint,
+            delta=LLMResultChunkDelta(
+                index=index,
+                message=AssistantPromptMessage(content="".join(buffer)),
+            ),
+        )
+        buffer.clear()
+        buffered_chars = 0
+        pending = None
+        last_flush = time.monotonic()
+        return merged_chunk
+
+    for chunk in chunks:
+        delta = chunk.delta
+        content = delta.message.content
+        if (
+            delta.finish_reason is not None
+            or delta.usage is not None
+            or delta.message.tool_calls
+            or not isinstance(content, str)
+        ):
+            if buffer:
+                yield flush()
+            yield chunk
+            last_flush = time.monotonic()
+            continue
+
+        buffer.append(content)
+        buffered_chars += len(content)
+        pending = (chunk.model, chunk.prompt_messages, chunk.system_fingerprint, delta.index)
+
+        if (
+            buffered_chars >= max_chars
+            or time.monotonic() - last_flush >= max_seconds
+        ):
+            yield flush()
+
+    if buffer:
+        yield flush()
+
+
+def _user_message_to_dict(message: UserPromptMessage) -> dict:
+    """
+    Convert UserPromptMessage to dict for OpenAI API
+    """
+    content = message.content
+    if isinstance(content, str):
+        message_dict = {"role": "user", "content": content}
+    else:
+        sub_messages = []
+        assert isinstance(content, list)
+        for message_content in content:
+            content_type = message_content.type
+            if content_type == PromptMessageContentType.TEXT:
+                sub_message_dict = {
+                    "type": "text",
+                    "text": message_content.data,
+                }
+                sub_messages.append(sub_message_dict)
+            elif content_type == PromptMessageContentType.IMAGE:
+                sub_message_dict = {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": message_content.data,
+                        "detail": message_content.detail.value,
+                    },
+                }
+                sub_messages.append(sub_message_dict)
+            elif isinstance(message_content, AudioPromptMessageContent):
+                if message_content.url:
+                    # a data url carries the payload after the base64 marker,
+                    # anything else is taken as raw base64 already
+                    prefix, marker, base64_data = message_content.url.partition(
+                        ";base64,"
+                    )
+                    if not marker:
+                        base64_data = prefix
+                else:
+                    # data would only wrap base64_data into a data url to be split again
+                    base64_data = message_content.base64_data
+                sub_message_dict = {
+                    "type": "input_audio",
+                    "input_audio": {
+                        "data": base64_data,
+                        "format": message_content.format,
+                    },
+                }
+                sub_messages.append(sub_message_dict)
+
+        message_dict = {"role": "user", "content": sub_messages}
+
+    name = message.name
+    if name:
+        message_dict["name"] = name
+
+    return message_dict
+
+
+def _assistant_message_to_dict(message: AssistantPromptMessage) -> dict:
+    """
+    Convert AssistantPromptMessage to dict for OpenAI API
+    """
+    message_dict = {"role": "assistant", "content": message.content}
+
+    # If assistant wants to call tools, attach tool_calls per new spec
+    tool_calls = message.tool_calls
+    if tool_calls:
+        message_dict["tool_calls"] = [
+            {
+                "id": tool_call.id,
+                "type": tool_call.type or "function",
+                "function": {
+                    "name": tool_call.function.name,
+                    "arguments": tool_call.function.arguments,
+                },
+            }
+            for tool_call in tool_calls
+        ]
+
+    name = message.name
+    if name:
+        message_dict["name"] = name
+
+    return message_dict
+
+
+def _system_message_to_dict(message: SystemPromptMessage) -> dict:
+    """
+    Convert SystemPromptMessage to dict for OpenAI API
+    """
+    message_dict = {"role": "system", "content": message.content}
+
+    name = message.name
+    if name:
+        message_dict["name"] = name
+
+    return message_dict
+
+
+def _tool_message_to_dict(message: ToolPromptMessage) -> dict:
+    """
+    Convert ToolPromptMessage to dict for OpenAI API, tool messages never carry a name
+    """
+    return {
+        "role": "tool",
+        "content": message.content,
+        "tool_call_id": message.tool_call_id,
+    }
+
+
+# message converters keyed by exact message type
+_MSG_CONVERTERS: dict[type, Callable[[Any], dict]] = {
+    UserPromptMessage: _user_message_to_dict,
+    AssistantPromptMessage: _assistant_message_to_dict,
+    SystemPromptMessage: _system_message_to_dict,
+    ToolPromptMessage: _tool_message_to_dict,
+    # messages already in OpenAI's wire format pass through unchanged
+    dict: lambda message: message,
+}
+
+# roles of message types whose dict is just role, string content and optional name
+_TEXT_MESSAGE_ROLES: dict[type, str] = {
+    UserPromptMessage: "user",
+    AssistantPromptMessage: "assistant",
+    SystemPromptMessage: "system",
+}
+
+
 class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
     """
     Model class for OpenAI large language model.
     """
 
+    @classmethod
+    def clear_tokenizer_cache(cls) -> None:
+        """
+        Drop all cached tokenizers and token counts, mainly for tests
+        """
+        _resolve_model.cache_clear()
+        _get_encoding_for.cache_clear()
+        _const_key_lens.cache_clear()
+        _fast_tokenizer.cache_clear()
+        _prefix_token_cache.clear()
+
+    @cached_property
+    def _predefined_model_modes(self) -> dict[str, LLMMode]:
+        """
+        Model modes of predefined models, resolved once per model instance
+        """
+        model_modes = {}
+        for model_schema in self.predefined_models():
+            model_modes[model_schema.model] = super().get_model_mode(model_schema.model)
+
+        return model_modes
+
+    @cached_property
+    def _predefined_model_map(self) -> dict[str, AIModelEntity]:
+        """
+        Predefined model schemas by model name, resolved once per model instance
+        """
+        return {model_schema.model: model_schema for model_schema in self.predefined_models()}
+
+    @cached_property
+    def _customizable_model_schemas(self) -> LRU:
+        """
+        Schemas built by get_customizable_model_schema, by fine-tuned model name
+        """
+        return LRU(maxsize=256)
+
+    def get_model_mode(
+        self, model: str, credentials: Optional[Mapping] = None
+    ) -> LLMMode:
+        """
+        Get model mode, predefined models do not depend on credentials so they are served from cache
+
+        :param model: model name
+        :param credentials: model credentials
+        :return: model mode
+        """
+        model_mode = self._predefined_model_modes.get(model)
+        if model_mode is None:
+            model_mode = super().get_model_mode(model, credentials)
+
+        return model_mode
+
+    def _client_for(self, credentials_kwargs: dict) -> OpenAI:
+        """
+        Get an OpenAI client for the given kwargs, reusing a cached one when possible
+
+        :param credentials_kwargs: client kwargs, see _to_credential_kwargs
+        :return: OpenAI client
+        """
+        creds_key = _credentials_cache_key(credentials_kwargs)
+        return _client_cache.get_or_create(
+            creds_key,
+            lambda: OpenAI(
+                **credentials_kwargs,
+                http_client=DefaultHttpxClient(
+                    http2=_HTTP2_AVAILABLE,
+                    # keep openai's default connection cap, Limits would otherwise lift it
+                    limits=httpx.Limits(
+                        max_connections=1000, max_keepalive_connections=64
+                    ),
+                ),
+            ),
+        )
+
     def _invoke(
         self,
         model: str,
@@ -95,9 +814,7 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         :return: full response or stream response chunk generator result
         """
         # handle fine tune remote models
-        base_model = model
-        if model.startswith("ft:"):
-            base_model = model.split(":")[1]
+        base_model = _base_model(model)
 
         # get model mode
         model_mode = self.get_model_mode(base_model, credentials)
@@ -141,9 +858,7 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         Code block mode wrapper for invoking large language model
         """
         # handle fine tune remote models
-        base_model = model
-        if model.startswith("ft:"):
-            base_model = model.split(":")[1]
+        base_model = _base_model(model)
 
         # get model mode
         model_mode = self.get_model_mode(base_model, credentials)
@@ -152,10 +867,13 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         if "response_format" in model_parameters and model_parameters[
             "response_format"
         ] in ["JSON", "XML"]:
-            stop = stop or []
+            # work on copies, the caller's parameters and stop words stay untouched
+            model_parameters = dict(model_parameters)
+            response_format = model_parameters.pop("response_format")
+            stop = list(stop or [])
             if model_mode == LLMMode.CHAT:
                 # chat model
-                self._transform_chat_json_prompts(
+                prompt_messages = self._transform_chat_json_prompts(
                     model=base_model,
                     credentials=credentials,
                     prompt_messages=prompt_messages,
@@ -164,10 +882,10 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                     stop=stop,
                     stream=stream,
                     user=user,
-                    response_format=model_parameters["response_format"],
+                    response_format=response_format,
                 )
             else:
-                self._transform_completion_json_prompts(
+                prompt_messages = self._transform_completion_json_prompts(
                     model=base_model,
                     credentials=credentials,
                     prompt_messages=prompt_messages,
@@ -176,9 +894,8 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                     stop=stop,
                     stream=stream,
                     user=user,
-                    response_format=model_parameters["response_format"],
+                    response_format=response_format,
                 )
-            model_parameters.pop("response_format")
 
         return self._invoke(
             model=model,
@@ -202,9 +919,9 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         stream: bool = True,
         user: str | None = None,
         response_format: str = "JSON",
-    ) -> None:
+    ) -> list[PromptMessage]:
         """
-        Transform json prompts
+        Transform json prompts, returns a new list and leaves prompt_messages untouched
         """
         stop = stop or []
 
@@ -217,30 +934,28 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         if len(prompt_messages) > 0 and isinstance(
             prompt_messages[0], SystemPromptMessage
         ):
-            assert isinstance(prompt_messages[0].content, str)
             # override the system message
-            prompt_messages[0] = SystemPromptMessage(
-                content=OPENAI_BLOCK_MODE_PROMPT.replace(
-                    "{{instructions}}", prompt_messages[0].content
-                ).replace("{{block}}", response_format)
-            )
-            prompt_messages.append(
-                AssistantPromptMessage(content=f"\n```{response_format}\n")
-            )
-        else:
-            # insert the system message
-            prompt_messages.insert(
-                0,
+            return [
                 SystemPromptMessage(
-                    content=OPENAI_BLOCK_MODE_PROMPT.replace(
-                        "{{instructions}}",
-                        f"Please output a valid {response_format} object.",
-                    ).replace("{{block}}", response_format)
+                    content=_block_mode_prompt(
+                        _require_str(prompt_messages[0].content), response_format
+                    )
                 ),
-            )
-            prompt_messages.append(
-                AssistantPromptMessage(content=f"\n```{response_format}")
-            )
+                *prompt_messages[1:],
+                AssistantPromptMessage(content=f"\n```{response_format}\n"),
+            ]
+
+        # insert the system message
+        return [
+            SystemPromptMessage(
+                content=_block_mode_prompt(
+                    f"Please output a valid {response_format} object.",
+                    response_format,
+                )
+            ),
+            *prompt_messages,
+            AssistantPromptMessage(content=f"\n```{response_format}"),
+        ]
 
     def _transform_completion_json_prompts(
         self,
@@ -253,9 +968,9 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         stream: bool = True,
         user: str | None = None,
         response_format: str = "JSON",
-    ) -> None:
+    ) -> list[PromptMessage]:
         """
-        Transform json prompts
+        Transform json prompts, returns a new list and leaves prompt_messages untouched
         """
         stop = stop or []
 
@@ -265,41 +980,34 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
             stop.append("\n```")
 
         # override the last user message
-        user_message = None
-        i = None
-        for i in range(len(prompt_messages) - 1, -1, -1):
-            if isinstance(prompt_messages[i], UserPromptMessage):
-                user_message = prompt_messages[i]
-                break
-
-        assert isinstance(i, int)
+        i, user_message = next(
+            (
+                (idx, m)
+                for idx, m in zip(
+                    range(len(prompt_messages) - 1, -1, -1), reversed(prompt_messages)
+                )
+                if type(m) is UserPromptMessage
+            ),
+            (None, None),
+        )
 
-        if user_message:
-            assert isinstance(prompt_messages, list)
-            assert isinstance(prompt_messages[i], PromptMessage)
-            content = prompt_messages[i].content
-            assert isinstance(content, str)
+        prompt_messages = list(prompt_messages)
+        if user_message is not None:
+            content = _require_str(user_message.content)
 
-            if content[-11:] == "Assistant: ":
-                assert isinstance(user_message.content, str)
+            if content.endswith("Assistant: "):
                 # now we are in the chat app, remove the last assistant message
-                prompt_messages[i].content = content[:-11]
-                prompt_messages[i] = UserPromptMessage(
-                    content=OPENAI_BLOCK_MODE_PROMPT.replace(
-                        "{{instructions}}", user_message.content
-                    ).replace("{{block}}", response_format)
-                )
-                prompt_messages[i].content += f"Assistant:\n```{response_format}\n"  # type: ignore
+                instructions = content[:-11]
+                suffix = f"Assistant:\n```{response_format}\n"
             else:
-                assert isinstance(user_message.content, str)
+                instructions = content
+                suffix = f"\n```{response_format}\n"
 
-                prompt_messages[i] = UserPromptMessage(
-                    content=OPENAI_BLOCK_MODE_PROMPT.replace(
-                        "{{instructions}}", user_message.content
-                    ).replace("{{block}}", response_format)
-                )
+            prompt_messages[i] = UserPromptMessage(
+                content=_block_mode_prompt(instructions, response_format) + suffix
+            )
 
-                prompt_messages[i].content += f"\n```{response_format}\n"  # type: ignore
+        return prompt_messages
 
     def get_num_tokens(
         self,
@@ -318,10 +1026,7 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         :return:
         """
         # handle fine tune remote models
-        if model.startswith("ft:"):
-            base_model = model.split(":")[1]
-        else:
-            base_model = model
+        base_model = _base_model(model)
 
         # get model mode
         model_mode = self.get_model_mode(model)
@@ -331,8 +1036,7 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
             return self._num_tokens_from_messages(base_model, prompt_messages, tools)
         else:
             # text completion model, do not support tool calling
-            content = prompt_messages[0].content
-            assert isinstance(content, str)
+            content = _require_str(prompt_messages[0].content)
             return self._num_tokens_from_string(base_model, content)
 
     def validate_credentials(self, model: str, credentials: dict) -> None:
@@ -346,14 +1050,12 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         try:
             # transform credentials to kwargs for model instance
             credentials_kwargs = self._to_credential_kwargs(credentials)
-            client = OpenAI(**credentials_kwargs)
+            client = self._client_for(credentials_kwargs)
 
             # handle fine tune remote models
-            base_model = model
             # fine-tuned model name likes ft:gpt-3.5-turbo-0613:personal::xxxxx
+            base_model = _base_model(model)
             if model.startswith("ft:"):
-                base_model = model.split(":")[1]
-
                 # check if model exists
                 remote_models = self.remote_models(credentials)
                 remote_model_map = {model.model: model for model in remote_models}
@@ -394,12 +1096,11 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         :return:
         """
         # get predefined models
-        predefined_models = self.predefined_models()
-        predefined_models_map = {model.model: model for model in predefined_models}
+        predefined_models_map = self._predefined_model_map
 
         # transform credentials to kwargs for model instance
         credentials_kwargs = self._to_credential_kwargs(credentials)
-        client = OpenAI(**credentials_kwargs)
+        client = self._client_for(credentials_kwargs)
 
         # get all remote models
         remote_models = client.models.list()
@@ -408,17 +1109,28 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
             model for model in remote_models if model.id.startswith("ft:")
         ]
 
+        automaton = None
+        if ahocorasick is not None and predefined_models_map:
+            automaton = _predefined_ac(tuple(predefined_models_map))
+
         ai_model_entities = []
         for model in fine_tune_models:
-            base_model = model.id.split(":")[1]
+            base_model = _base_model(model.id)
 
+            # the last predefined model (in schema order) contained in the base model wins
             base_model_schema = None
-            for (
-                predefined_model_name,
-                predefined_model,
-            ) in predefined_models_map.items():
-                if predefined_model_name in base_model:
-                    base_model_schema = predefined_model
+            if automaton is not None:
+                matches = [match for _, match in automaton.iter(base_model)]
+                if matches:
+                    _, predefined_model_name = max(matches)
+                    base_model_schema = predefined_models_map[predefined_model_name]
+            else:
+                for (
+                    predefined_model_name,
+                    predefined_model,
+                ) in predefined_models_map.items():
+                    if predefined_model_name in base_model:
+                        base_model_schema = predefined_model
 
             if not base_model_schema:
                 continue
@@ -469,7 +1181,7 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         credentials_kwargs = self._to_credential_kwargs(credentials)
 
         # init model client
-        client = OpenAI(**credentials_kwargs)
+        client = self._client_for(credentials_kwargs)
 
         extra_model_kwargs = {}
 
@@ -483,10 +1195,10 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
             extra_model_kwargs["stream_options"] = {"include_usage": True}
 
         # text completion model
-        assert isinstance(prompt_messages[0].content, str)
+        prompt = _require_str(prompt_messages[0].content)
 
         response = client.completions.create(
-            prompt=prompt_messages[0].content,
+            prompt=prompt,
             model=model,
             stream=stream,
             **model_parameters,
@@ -495,8 +1207,10 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
 
         if stream:
             assert isinstance(response, Stream)
-            return self._handle_generate_stream_response(
-                model, credentials, response, prompt_messages
+            return _coalesce_stream(
+                self._handle_generate_stream_response(
+                    model, credentials, response, prompt_messages
+                )
             )
 
         assert isinstance(response, Completion)
@@ -532,9 +1246,8 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
             completion_tokens = response.usage.completion_tokens
         else:
             # calculate num tokens
-            assert isinstance(prompt_messages[0].content, str)
             prompt_tokens = self._num_tokens_from_string(
-                model, prompt_messages[0].content
+                model, _require_str(prompt_messages[0].content)
             )
             completion_tokens = self._num_tokens_from_string(model, assistant_text)
 
@@ -574,6 +1287,10 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         prompt_tokens = 0
         completion_tokens = 0
 
+        # fields shared by every streamed chunk, prompt_messages is always emptied by
+        # LLMResultChunk's validator, which model_construct skips
+        chunk_kwargs = {"prompt_messages": []}
+
         final_chunk = LLMResultChunk(
             model=model,
             prompt_messages=prompt_messages,
@@ -596,9 +1313,12 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
             if delta.finish_reason is None and (delta.text is None or delta.text == ""):
                 continue
 
-            # transform assistant message to prompt message
+            # transform assistant message to prompt message,
+            # text is a trusted SDK string so pydantic validation is skipped on this hot path
             text = delta.text if delta.text else ""
-            assistant_prompt_message = AssistantPromptMessage(content=text)
+            assistant_prompt_message = AssistantPromptMessage.model_construct(
+                content=text
+            )
 
             full_text += text
 
@@ -614,20 +1334,19 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                     ),
                 )
             else:
-                yield LLMResultChunk(
+                yield LLMResultChunk.model_construct(
                     model=chunk.model,
-                    prompt_messages=prompt_messages,
                     system_fingerprint=chunk.system_fingerprint,
-                    delta=LLMResultChunkDelta(
+                    delta=LLMResultChunkDelta.model_construct(
                         index=delta.index,
                         message=assistant_prompt_message,
                     ),
+                    **chunk_kwargs,
                 )
 
         if not prompt_tokens:
-            assert isinstance(prompt_messages[0].content, str)
             prompt_tokens = self._num_tokens_from_string(
-                model, prompt_messages[0].content
+                model, _require_str(prompt_messages[0].content)
             )
 
         if not completion_tokens:
@@ -656,9 +1375,12 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         """
         Invoke llm chat model
 
+        Callers that already hold messages in OpenAI's wire format may pass them as dicts,
+        alone or mixed with prompt messages, they are sent without conversion.
+
         :param model: model name
         :param credentials: credentials
-        :param prompt_messages: prompt messages
+        :param prompt_messages: prompt messages, or OpenAI message dicts
         :param model_parameters: model parameters
         :param tools: tools for tool calling
         :param stop: stop words
@@ -670,7 +1392,10 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         credentials_kwargs = self._to_credential_kwargs(credentials)
 
         # init model client
-        client = OpenAI(**credentials_kwargs)
+        client = self._client_for(credentials_kwargs)
+
+        # parameters are rewritten below, keep the caller's dict untouched
+        model_parameters = dict(model_parameters)
 
         response_format = model_parameters.get("response_format")
         if response_format:
@@ -679,7 +1404,11 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                 if not json_schema:
                     raise ValueError("Must define JSON Schema when the response format is json_schema")
                 try:
-                    schema = json.loads(json_schema)
+                    schema = (
+                        json_schema
+                        if isinstance(json_schema, dict)
+                        else _parse_schema(json_schema)
+                    )
                 except Exception:
                     raise ValueError(f"not correct json_schema format: {json_schema}")
                 model_parameters.pop("json_schema")
@@ -726,9 +1455,11 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         # clear illegal prompt messages
         prompt_messages = self._clear_illegal_prompt_messages(model, prompt_messages)
 
+        model_class = _model_class(model)
+
         # o1, o3, o4 compatibility
         block_as_stream = False
-        if model.startswith(O_SERIES_COMPATIBILITY):
+        if model_class & MODEL_CLASS_O_SERIES:
             if "max_tokens" in model_parameters:
                 model_parameters["max_completion_tokens"] = model_parameters[
                     "max_tokens"
@@ -738,7 +1469,7 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
             if "stop" in extra_model_kwargs:
                 del extra_model_kwargs["stop"]
 
-        if "o3-pro" in model:
+        if model_class & MODEL_CLASS_O3_PRO:
             block_result = self._chat_generate_o3_pro(
                 model=model,
                 credentials=credentials,
@@ -748,9 +1479,14 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                 user=user,
             )
         else:
-            # chat model
-            messages: Any = [self._convert_prompt_message_to_dict(m) for m in prompt_messages]
-            
+            # chat model, dicts already in OpenAI's wire format are passed through
+            messages: Any = [
+                _MSG_CONVERTERS[type(m)](m)
+                if type(m) in _MSG_CONVERTERS
+                else self._convert_prompt_message_to_dict(m)
+                for m in prompt_messages
+            ]
+
             try:
                 response = client.chat.completions.create(
                     messages=messages,
@@ -765,9 +1501,25 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
 
             if stream:
                 logger.info(f"OpenAI API Response - Stream response initiated for model: {model}")
-                return self._handle_chat_generate_stream_response(model, credentials, response, prompt_messages, tools)
+                return _coalesce_stream(
+                    self._handle_chat_generate_stream_response(
+                        model,
+                        credentials,
+                        response,
+                        prompt_messages,
+                        tools,
+                        messages_dict=messages,
+                    ),
+                )
 
-            block_result = self._handle_chat_generate_response(model, credentials, response, prompt_messages, tools)
+            block_result = self._handle_chat_generate_response(
+                model,
+                credentials,
+                response,
+                prompt_messages,
+                tools,
+                messages_dict=messages,
+            )
 
         if block_as_stream:
             return self._handle_chat_block_as_stream_response(block_result, prompt_messages, stop)
@@ -787,29 +1539,55 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         Invoke o3-pro model using responses.create API.
         """
         # 1. Prepare input string from prompt messages
-        input_parts = []
         role_map = {
             UserPromptMessage: "user",
             AssistantPromptMessage: "assistant",
             ToolPromptMessage: "tool",
         }
+        input_buffer = io.StringIO()
         for m in prompt_messages:
-            role = role_map.get(type(m))
-            if not role:
-                continue
-
-            content_str = ""
-            if isinstance(m.content, str):
-                content_str = m.content
-            elif isinstance(m.content, list):
-                content_str = "\n".join(
-                    [item.data for item in m.content if item.type == PromptMessageContentType.TEXT]
-                )
-            
-            if content_str:
-                input_parts.append(f"{role}: {content_str}")
-        
-        final_input = "\n\n".join(input_parts)
+            if type(m) is dict:
+                # OpenAI wire format, only the roles above are sent
+                role = m.get("role")
+                if role not in role_map.values():
+                    continue
+                content = m.get("content")
+                if isinstance(content, list):
+                    content = [
+                        item["text"]
+                        for item in content
+                        if isinstance(item, dict) and item.get("type") == "text"
+                    ]
+            else:
+                role = role_map.get(type(m))
+                if not role:
+                    continue
+                content = m.content
+                if isinstance(content, list):
+                    content = [
+                        item.data
+                        for item in content
+                        if item.type == PromptMessageContentType.TEXT
+                    ]
+
+            message_start = input_buffer.tell()
+            if message_start:
+                input_buffer.write("\n\n")
+            input_buffer.write(role)
+            input_buffer.write(": ")
+            content_start = input_buffer.tell()
+
+            if isinstance(content, str):
+                input_buffer.write(content)
+            elif isinstance(content, list):
+                input_buffer.write("\n".join(content))
+
+            if input_buffer.tell() == content_start:
+                # skip messages without text content
+                input_buffer.seek(message_start)
+                input_buffer.truncate()
+
+        final_input = input_buffer.getvalue()
 
         # 2. Adapt parameters for responses.create
         response_params = model_parameters.copy()
@@ -888,6 +1666,8 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         response: ChatCompletion,
         prompt_messages: list[PromptMessage],
         tools: Optional[list[PromptMessageTool]] = None,
+        *,
+        messages_dict: Optional[list[dict]] = None,
     ) -> LLMResult:
         """
         Handle llm chat response
@@ -897,6 +1677,7 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         :param response: response
         :param prompt_messages: prompt messages
         :param tools: tools for tool calling
+        :param messages_dict: prompt messages already converted for the request, if any
         :return: llm response
         """
         assistant_message = response.choices[0].message
@@ -924,7 +1705,7 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         else:
             # calculate num tokens
             prompt_tokens = self._num_tokens_from_messages(
-                model, prompt_messages, tools
+                model, prompt_messages, tools, messages_dict=messages_dict
             )
             completion_tokens = self._num_tokens_from_messages(
                 model, [assistant_prompt_message]
@@ -951,6 +1732,8 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         response: Stream[ChatCompletionChunk],
         prompt_messages: list[PromptMessage],
         tools: Optional[list[PromptMessageTool]] = None,
+        *,
+        messages_dict: Optional[list[dict]] = None,
     ) -> Generator:
         """
         Handle llm chat stream response
@@ -959,16 +1742,20 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         :param response: response
         :param prompt_messages: prompt messages
         :param tools: tools for tool calling
+        :param messages_dict: prompt messages already converted for the request, if any
         :return: llm response chunk generator
         """
-        full_assistant_content = ""
+        full_assistant_content_parts: list[str] = []
         delta_assistant_message_function_call_storage: Optional[
             ChoiceDeltaFunctionCall
         ] = None
         prompt_tokens = 0
         completion_tokens = 0
-        final_tool_calls = []
-        aggregated_tool_calls: dict[int, ChoiceDeltaToolCall] = {}
+        usage_seen = False
+        # streamed tool calls by their index, with the argument fragments kept apart
+        # and joined once the calls are complete
+        tool_call_objs: list[Optional[ChoiceDeltaToolCall]] = []
+        tool_call_args: list[Optional[list[str]]] = []
         final_chunk = LLMResultChunk(
             model=model,
             prompt_messages=prompt_messages,
@@ -979,11 +1766,14 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         )
 
         for chunk in response:
+            # usage normally arrives in a trailing chunk without choices,
+            # some compatible servers attach it to the last choice chunk instead
+            if chunk.usage:
+                prompt_tokens = chunk.usage.prompt_tokens
+                completion_tokens = chunk.usage.completion_tokens
+                usage_seen = True
+
             if len(chunk.choices) == 0:
-                if chunk.usage:
-                    # calculate num tokens
-                    prompt_tokens = chunk.usage.prompt_tokens
-                    completion_tokens = chunk.usage.completion_tokens
                 continue
 
             delta = chunk.choices[0]
@@ -995,31 +1785,32 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                     # doc: https://platform.lingyiwanwu.com/docs/api-reference
                     has_finish_reason = delta.finish_reason.startswith(("length", "stop", "content_filter"))
 
+            delta_message = delta.delta
+            content = delta_message.content
+            assistant_message_tool_calls = delta_message.tool_calls
+            assistant_message_function_call = delta_message.function_call
+
             if (
                 not has_finish_reason
-                and (delta.delta.content is None or delta.delta.content == "")
-                and delta.delta.tool_calls is None
-                and delta.delta.function_call is None
+                and not content
+                and assistant_message_tool_calls is None
+                and assistant_message_function_call is None
             ):
                 continue
 
-            assistant_message_tool_calls = delta.delta.tool_calls
-            assistant_message_function_call = delta.delta.function_call
-
-            # extract tool calls from response (new preferred path)
-            if assistant_message_tool_calls:
-                tool_calls = self._extract_response_tool_calls(assistant_message_tool_calls)  # type: ignore
-            else:
+            # tool call fragments (new preferred path) are aggregated below,
+            # legacy function call fragments are only skipped until the call is complete
+            if not assistant_message_tool_calls:
                 # legacy streaming via function_call
                 if delta_assistant_message_function_call_storage is not None:
                     if assistant_message_function_call:
                         # message continues
-                        assert isinstance(delta_assistant_message_function_call_storage.arguments, str)
-                        assert isinstance(assistant_message_function_call.arguments, str)
-                        delta_assistant_message_function_call_storage.arguments += assistant_message_function_call.arguments
+                        # storage arguments are initialized to "" when the legacy stream starts
+                        delta_assistant_message_function_call_storage.arguments += (  # type: ignore
+                            assistant_message_function_call.arguments or ""
+                        )
                         continue
                     else:
-                        assistant_message_function_call = delta_assistant_message_function_call_storage
                         delta_assistant_message_function_call_storage = None
                 else:
                     if assistant_message_function_call:
@@ -1030,21 +1821,30 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                         if not has_finish_reason:
                             continue
 
-                function_call = self._extract_response_function_call(assistant_message_function_call)
-                tool_calls = [function_call] if function_call else []
-
-            if tool_calls:
-                final_tool_calls.extend(tool_calls)
-            
             # STATEFUL AGGREGATION OF TOOL CALLS
             if assistant_message_tool_calls:
                 for tool_call_chunk in assistant_message_tool_calls:
+                    index = tool_call_chunk.index or 0
+                    known = (
+                        index < len(tool_call_objs)
+                        and tool_call_objs[index] is not None
+                    )
                     # new tool
-                    if tool_call_chunk.id and tool_call_chunk.index not in aggregated_tool_calls:
-                         aggregated_tool_calls[tool_call_chunk.index] = tool_call_chunk
+                    if tool_call_chunk.id and not known:
+                        if index >= len(tool_call_objs):
+                            grow = index + 1 - len(tool_call_objs)
+                            tool_call_objs.extend([None] * grow)
+                            tool_call_args.extend([None] * grow)
+                        tool_call_objs[index] = tool_call_chunk
+                        tool_call_args[index] = (
+                            [tool_call_chunk.function.arguments]
+                            if tool_call_chunk.function
+                            and tool_call_chunk.function.arguments
+                            else []
+                        )
                     # existing tool
-                    elif tool_call_chunk.index in aggregated_tool_calls:
-                        existing_call = aggregated_tool_calls[tool_call_chunk.index]
+                    elif known:
+                        existing_call = tool_call_objs[index]
                         if tool_call_chunk.id:
                             existing_call.id = tool_call_chunk.id
                         if tool_call_chunk.type:
@@ -1053,12 +1853,20 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                             if tool_call_chunk.function.name:
                                 existing_call.function.name = tool_call_chunk.function.name
                             if tool_call_chunk.function.arguments:
-                                existing_call.function.arguments += tool_call_chunk.function.arguments
+                                tool_call_args[index].append(
+                                    tool_call_chunk.function.arguments
+                                )
 
             if has_finish_reason and delta.finish_reason == "tool_calls":
                 # all tool calls are finished, yield them
-                tool_calls = self._extract_response_tool_calls(list(aggregated_tool_calls.values()))
-                final_tool_calls.extend(tool_calls)
+                aggregated_tool_calls = []
+                for existing_call, argument_parts in zip(tool_call_objs, tool_call_args):
+                    if existing_call is None:
+                        continue
+                    if existing_call.function:
+                        existing_call.function.arguments = "".join(argument_parts)
+                    aggregated_tool_calls.append(existing_call)
+                tool_calls = self._extract_response_tool_calls(aggregated_tool_calls)
                 assistant_prompt_message = AssistantPromptMessage(
                     content="",
                     tool_calls=tool_calls
@@ -1076,13 +1884,15 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                 )
                 continue
 
-            # transform assistant message to prompt message
-            assistant_prompt_message = AssistantPromptMessage(
-                content=delta.delta.content if delta.delta.content else "",
-                tool_calls=[],
-            )
-
-            full_assistant_content += delta.delta.content if delta.delta.content else ""
+            # transform assistant message to prompt message,
+            # deltas are trusted SDK strings so pydantic validation is skipped on this hot path
+            if content:
+                assistant_prompt_message = AssistantPromptMessage.model_construct(
+                    content=content
+                )
+                full_assistant_content_parts.append(content)
+            else:
+                assistant_prompt_message = _EMPTY_ASSISTANT_MESSAGE
 
             if has_finish_reason:
                 final_chunk = LLMResultChunk(
@@ -1096,27 +1906,26 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
                     ),
                 )
             else:
-                yield LLMResultChunk(
+                # prompt_messages is always emptied by LLMResultChunk's validator,
+                # which model_construct skips, so pass the empty list directly
+                yield LLMResultChunk.model_construct(
                     model=chunk.model,
-                    prompt_messages=prompt_messages,
+                    prompt_messages=[],
                     system_fingerprint=chunk.system_fingerprint,
-                    delta=LLMResultChunkDelta(
+                    delta=LLMResultChunkDelta.model_construct(
                         index=delta.index,
                         message=assistant_prompt_message,
                     ),
                 )
 
-        if not prompt_tokens:
+        # only count locally when the server did not report usage,
+        # the streamed content is joined for this case alone
+        if not usage_seen:
             prompt_tokens = self._num_tokens_from_messages(
-                model, prompt_messages, tools
+                model, prompt_messages, tools, messages_dict=messages_dict
             )
-
-        if not completion_tokens:
-            full_assistant_prompt_message = AssistantPromptMessage(
-                content=full_assistant_content, tool_calls=final_tool_calls
-            )
-            completion_tokens = self._num_tokens_from_messages(
-                model, [full_assistant_prompt_message]
+            completion_tokens = self._num_tokens_for_completion(
+                model, "".join(full_assistant_content_parts)
             )
 
         # transform usage
@@ -1137,27 +1946,23 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         :param response_tool_calls: response tool calls
         :return: list of tool calls
         """
-        tool_calls = []
-        if response_tool_calls:
-            for response_tool_call in response_tool_calls:
-                assert isinstance(
-                    response_tool_call,
-                    (ChatCompletionMessageToolCall, ChoiceDeltaToolCall),
-                )
-                if response_tool_call.function:
-                    function = AssistantPromptMessage.ToolCall.ToolCallFunction(
-                        name=response_tool_call.function.name or "",
-                        arguments=response_tool_call.function.arguments or "",
-                    )
-
-                    tool_call = AssistantPromptMessage.ToolCall(
-                        id=response_tool_call.id or "",
-                        type=response_tool_call.type or "",
-                        function=function,
-                    )
-                    tool_calls.append(tool_call)
-
-        return tool_calls
+        if not response_tool_calls:
+            return []
+
+        tool_call_cls = AssistantPromptMessage.ToolCall
+        function_cls = tool_call_cls.ToolCallFunction
+        return [
+            tool_call_cls(
+                id=response_tool_call.id or "",
+                type=response_tool_call.type or "",
+                function=function_cls(
+                    name=response_tool_call.function.name or "",
+                    arguments=response_tool_call.function.arguments or "",
+                ),
+            )
+            for response_tool_call in response_tool_calls
+            if response_tool_call.function
+        ]
 
     def _extract_response_function_call(
         self, response_function_call: Optional[FunctionCall | ChoiceDeltaFunctionCall]
@@ -1195,27 +2000,57 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         :param prompt_messages: prompt messages
         :return: cleaned prompt messages
         """
-        checklist = ["gpt-4-turbo", "gpt-4-turbo-2024-04-09"]
+        if model not in CONTENT_FLATTENING_MODELS:
+            return prompt_messages
 
-        if model in checklist:
-            # count how many user messages are there
-            user_message_count = len(
-                [m for m in prompt_messages if isinstance(m, UserPromptMessage)]
-            )
-            if user_message_count > 1:
-                for prompt_message in prompt_messages:
-                    if isinstance(prompt_message, UserPromptMessage):
-                        if isinstance(prompt_message.content, list):
-                            prompt_message.content = "\n".join(
-                                [
+        # count user messages, stopping as soon as there is more than one
+        user_message_count = 0
+        for m in prompt_messages:
+            if isinstance(m, UserPromptMessage) or (
+                type(m) is dict and m.get("role") == "user"
+            ):
+                user_message_count += 1
+                if user_message_count > 1:
+                    break
+
+        if user_message_count > 1:
+            # replace the affected messages with copies instead of mutating the caller's objects
+            new_prompt_messages = []
+            for prompt_message in prompt_messages:
+                if isinstance(prompt_message, UserPromptMessage):
+                    if isinstance(prompt_message.content, list):
+                        prompt_message = prompt_message.model_copy(
+                            update={
+                                "content": "\n".join(
                                     item.data
                                     if item.type == PromptMessageContentType.TEXT
                                     else "[IMAGE]"
                                     if item.type == PromptMessageContentType.IMAGE
                                     else ""
                                     for item in prompt_message.content
-                                ]
-                            )
+                                )
+                            }
+                        )
+                elif (
+                    type(prompt_message) is dict
+                    and prompt_message.get("role") == "user"
+                    and isinstance(prompt_message.get("content"), list)
+                ):
+                    # OpenAI wire format, image parts are typed image_url
+                    prompt_message = {
+                        **prompt_message,
+                        "content": "\n".join(
+                            item.get("text", "")
+                            if item.get("type") == "text"
+                            else "[IMAGE]"
+                            if item.get("type") == "image_url"
+                            else ""
+                            for item in prompt_message["content"]
+                        ),
+                    }
+
+                new_prompt_messages.append(prompt_message)
+            prompt_messages = new_prompt_messages
 
         # The system prompt will be converted to developer message so we don't need to do this
         
@@ -1242,82 +2077,17 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         """
         Convert PromptMessage to dict for OpenAI API
         """
-        if isinstance(message, UserPromptMessage):
-            message = cast(UserPromptMessage, message)
-            if isinstance(message.content, str):
-                message_dict = {"role": "user", "content": message.content}
+        converter = _MSG_CONVERTERS.get(type(message))
+        if converter is None:
+            # subclasses of the known message types fall back to an isinstance lookup
+            for message_type, message_converter in _MSG_CONVERTERS.items():
+                if isinstance(message, message_type):
+                    converter = message_converter
+                    break
             else:
-                sub_messages = []
-                assert isinstance(message.content, list)
-                for message_content in message.content:
-                    if message_content.type == PromptMessageContentType.TEXT:
-                        message_content = cast(
-                            TextPromptMessageContent, message_content
-                        )
-                        sub_message_dict = {
-                            "type": "text",
-                            "text": message_content.data,
-                        }
-                        sub_messages.append(sub_message_dict)
-                    elif message_content.type == PromptMessageContentType.IMAGE:
-                        message_content = cast(
-                            ImagePromptMessageContent, message_content
-                        )
-                        sub_message_dict = {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": message_content.data,
-                                "detail": message_content.detail.value,
-                            },
-                        }
-                        sub_messages.append(sub_message_dict)
-                    elif isinstance(message_content, AudioPromptMessageContent):
-                        data_split = message_content.data.split(";base64,")
-                        base64_data = data_split[1]
-                        sub_message_dict = {
-                            "type": "input_audio",
-                            "input_audio": {
-                                "data": base64_data,
-                                "format": message_content.format,
-                            },
-                        }
-                        sub_messages.append(sub_message_dict)
-
-                message_dict = {"role": "user", "content": sub_messages}
-        elif isinstance(message, AssistantPromptMessage):
-            message = cast(AssistantPromptMessage, message)
-            message_dict = {"role": "assistant", "content": message.content}
-
-            # If assistant wants to call tools, attach tool_calls per new spec
-            if message.tool_calls:
-                message_dict["tool_calls"] = [
-                    {
-                        "id": tool_call.id,
-                        "type": tool_call.type or "function",
-                        "function": {
-                            "name": tool_call.function.name,
-                            "arguments": tool_call.function.arguments,
-                        },
-                    }
-                    for tool_call in message.tool_calls
-                ]
-        elif isinstance(message, SystemPromptMessage):
-            message = cast(SystemPromptMessage, message)
-            message_dict = {"role": "system", "content": message.content}
-        elif isinstance(message, ToolPromptMessage):
-            message = cast(ToolPromptMessage, message)
-            message_dict = {
-                "role": "tool",
-                "content": message.content,
-                "tool_call_id": message.tool_call_id,
-            }
-        else:
-            raise ValueError(f"Got unknown type {message}")
-
-        if message.name and message_dict.get("role") != "tool":
-            message_dict["name"] = message.name
+                raise ValueError(f"Got unknown type {message}")
 
-        return message_dict
+        return converter(message)
 
     def _num_tokens_from_string(
         self, model: str, text: str, tools: Optional[list[PromptMessageTool]] = None
@@ -1330,12 +2100,16 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         :param tools: tools for tool calling
         :return: number of tokens
         """
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
+        encoding = _get_encoding_for(_resolve_model(model))
 
-        num_tokens = len(encoding.encode(text))
+        # BPE merges across arbitrary cut points, so plain text is cached as a whole
+        cache_key = _prefix_digest(
+            hashlib.sha1(f"text\0{encoding.name}\0{text}".encode())
+        )
+        num_tokens = _prefix_token_cache.get(cache_key)
+        if num_tokens is None:
+            num_tokens = len(encoding.encode(text, disallowed_special=()))
+            _prefix_token_cache.put(cache_key, num_tokens)
 
         if tools:
             num_tokens += self._num_tokens_for_tools(encoding, tools)
@@ -1347,78 +2121,90 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         model: str,
         messages: list[PromptMessage],
         tools: Optional[list[PromptMessageTool]] = None,
+        *,
+        messages_dict: Optional[list[dict]] = None,
     ) -> int:
         """Calculate num tokens for gpt-3.5-turbo and gpt-4 with tiktoken package.
 
+        messages_dict may pass the messages already converted for the request,
+        it must line up with messages one to one.
+
         Official documentation: https://github.com/openai/openai-cookbook/blob/
         main/examples/How_to_format_inputs_to_ChatGPT_models.ipynb"""
-        if model.startswith("ft:"):
-            model = model.split(":")[1]
+        model = _resolve_model(model)
+        encoding = _get_encoding_for(model)
+        tokens_per_message, tokens_per_name = _message_token_overhead(model)
+
+        # a single plain text message, e.g. a short prompt or a streamed completion,
+        # is counted directly without building its dict or consulting the caches
+        if len(messages) == 1:
+            message = messages[0]
+            role = _TEXT_MESSAGE_ROLES.get(type(message))
+            if (
+                role is not None
+                and type(message.content) is str
+                and not getattr(message, "tool_calls", None)
+            ):
+                parts = [role, message.content]
+                # every reply is primed with <im_start>assistant
+                num_tokens = tokens_per_message + 3
+                if message.name:
+                    parts.append(message.name)
+                    num_tokens += tokens_per_name
+                num_tokens += sum(_encode_lengths(encoding, parts))
 
-        # Currently, we can use gpt4o to calculate chatgpt-4o-latest's token.
-        if model == "chatgpt-4o-latest" or model.startswith(("o1", "o3", "o4", "gpt-4.1", "gpt-4.5")):
-            model = "gpt-4o"
+                if tools:
+                    num_tokens += self._num_tokens_for_tools(encoding, tools)
 
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            logger.warning("Warning: model not found. Using cl100k_base encoding.")
-            encoding_name = "cl100k_base"
-            encoding = tiktoken.get_encoding(encoding_name)
-
-        if model.startswith("gpt-3.5-turbo-0301"):
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            tokens_per_message = 4
-            # if there's a name, the role is omitted
-            tokens_per_name = -1
-        elif (
-            model.startswith("gpt-3.5-turbo")
-            or model.startswith("gpt-4")
-            or model.startswith(("o1", "o3", "o4"))
-        ):
-            tokens_per_message = 3
-            tokens_per_name = 1
-        else:
-            raise NotImplementedError(
-                f"get_num_tokens_from_messages() is not presently implemented "
-                f"for model {model}."
-                "See https://platform.openai.com/docs/advanced-usage/managing-tokens for for "
-                "information on how messages are converted to tokens."
+                return num_tokens
+
+        if messages_dict is None:
+            messages_dict = [self._convert_prompt_message_to_dict(m) for m in messages]
+
+        # every message is encoded on its own, so the count of a conversation prefix
+        # is exact and can be reused when later requests only append messages.
+        # Only the strings that are counted go into the key, image and audio payloads
+        # never do.
+        hasher = hashlib.sha1(
+            f"msgs\0{encoding.name}\0{tokens_per_message}\0{tokens_per_name}".encode()
+        )
+        prefix_keys = []
+        message_parts = []
+        for message in messages_dict:
+            parts = []
+            fixed_tokens = self._message_token_parts(
+                message, parts, tokens_per_message, tokens_per_name
             )
+            hasher.update(f"{fixed_tokens}\0{len(parts)}\0".encode())
+            for part in parts:
+                # length prefixed, parts may contain any character
+                hasher.update(f"{len(part)}:{part}".encode())
+            prefix_keys.append(_prefix_digest(hasher))
+            message_parts.append((parts, fixed_tokens))
+
         num_tokens = 0
-        messages_dict = [self._convert_prompt_message_to_dict(m) for m in messages]
-        for message in messages_dict:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                # Cast str(value) in case the message value is not a string
-                # This occurs with function messages
-                # TODO: The current token calculation method for the image type is not implemented,
-                #  which need to download the image and then get the resolution for calculation,
-                #  and will increase the request delay
-                if isinstance(value, list):
-                    text = ""
-                    for item in value:
-                        if isinstance(item, dict) and item["type"] == "text":
-                            text += item["text"]
-
-                    value = text
-
-                if key == "tool_calls":
-                    for tool_call in value:
-                        for t_key, t_value in tool_call.items():  # type: ignore
-                            num_tokens += len(encoding.encode(t_key))
-                            if t_key == "function":
-                                for f_key, f_value in t_value.items():
-                                    num_tokens += len(encoding.encode(f_key))
-                                    num_tokens += len(encoding.encode(f_value))
-                            else:
-                                num_tokens += len(encoding.encode(t_key))
-                                num_tokens += len(encoding.encode(t_value))
-                else:
-                    num_tokens += len(encoding.encode(str(value)))
+        start = 0
+        for i in range(len(prefix_keys) - 1, -1, -1):
+            cached_num_tokens = _prefix_token_cache.get(prefix_keys[i])
+            if cached_num_tokens is not None:
+                num_tokens = cached_num_tokens
+                start = i + 1
+                break
 
-                if key == "name":
-                    num_tokens += tokens_per_name
+        # collect the strings of all uncached messages and encode them in one go
+        parts = []
+        bounds = []
+        for i in range(start, len(messages_dict)):
+            parts.extend(message_parts[i][0])
+            bounds.append((len(parts), message_parts[i][1]))
+
+        lengths = _encode_lengths(encoding, parts)
+        offset = 0
+        for i, (end, message_tokens) in zip(range(start, len(messages_dict)), bounds):
+            message_tokens += sum(lengths[offset:end])
+            offset = end
+            num_tokens += message_tokens
+            _prefix_token_cache.put(prefix_keys[i], num_tokens)
 
         # every reply is primed with <im_start>assistant
         num_tokens += 3
@@ -1428,8 +2214,78 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
 
         return num_tokens
 
+    def _num_tokens_for_completion(self, model: str, content: str) -> int:
+        """
+        Calculate num tokens of a streamed completion, counted like the assistant message
+        it forms without building that message and its dict.
+
+        Tool calls of the completion are not counted, _message_token_parts flattens
+        them to an empty string as well.
+
+        :param model: model name
+        :param content: completion text
+        :return: number of tokens
+        """
+        model = _resolve_model(model)
+        encoding = _get_encoding_for(model)
+        tokens_per_message, _ = _message_token_overhead(model)
+
+        # every reply is primed with <im_start>assistant
+        num_tokens = tokens_per_message + 3
+        return num_tokens + sum(_encode_lengths(encoding, ["assistant", content]))
+
+    def _message_token_parts(
+        self,
+        message: dict,
+        parts: list[str],
+        tokens_per_message: int,
+        tokens_per_name: int,
+    ) -> int:
+        """
+        Collect the strings of a single message dict that count towards its tokens.
+
+        :param message: message dict for OpenAI API
+        :param parts: list the strings to encode are appended to
+        :param tokens_per_message: fixed tokens added for every message
+        :param tokens_per_name: fixed tokens added when the message carries a name
+        :return: number of fixed tokens not covered by parts
+        """
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            # Cast str(value) in case the message value is not a string
+            # This occurs with function messages
+            # TODO: The current token calculation method for the image type is not implemented,
+            #  which need to download the image and then get the resolution for calculation,
+            #  and will increase the request delay
+            if isinstance(value, list):
+                text = ""
+                for item in value:
+                    if isinstance(item, dict) and item["type"] == "text":
+                        text += item["text"]
+
+                value = text
+
+            if key == "tool_calls":
+                for tool_call in value:
+                    for t_key, t_value in tool_call.items():  # type: ignore
+                        parts.append(t_key)
+                        if t_key == "function":
+                            for f_key, f_value in t_value.items():
+                                parts.append(f_key)
+                                parts.append(f_value)
+                        else:
+                            parts.append(t_key)
+                            parts.append(t_value)
+            else:
+                parts.append(str(value))
+
+            if key == "name":
+                num_tokens += tokens_per_name
+
+        return num_tokens
+
     def _num_tokens_for_tools(
-        self, encoding: tiktoken.Encoding, tools: list[PromptMessageTool]
+        self, encoding: "tiktoken.Encoding", tools: list[PromptMessageTool]
     ) -> int:
         """
         Calculate num tokens for tool calling with tiktoken package.
@@ -1438,43 +2294,50 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
         :param tools: tools for tool calling
         :return: number of tokens
         """
+        key_lens = _const_key_lens(encoding.name)
+        # "type" and "function", then "name", "description", "parameters" and "type"
+        # of the function object
+        tool_key_tokens = (
+            2 * key_lens["type"]
+            + key_lens["function"]
+            + key_lens["name"]
+            + key_lens["description"]
+            + key_lens["parameters"]
+        )
+
         num_tokens = 0
+        parts = []
         for tool in tools:
-            num_tokens += len(encoding.encode("type"))
-            num_tokens += len(encoding.encode("function"))
+            num_tokens += tool_key_tokens
 
             # calculate num tokens for function object
-            num_tokens += len(encoding.encode("name"))
-            num_tokens += len(encoding.encode(tool.name))
-            num_tokens += len(encoding.encode("description"))
-            num_tokens += len(encoding.encode(tool.description))
+            parts.append(tool.name)
+            parts.append(tool.description)
             parameters = tool.parameters
-            num_tokens += len(encoding.encode("parameters"))
             if "title" in parameters:
-                num_tokens += len(encoding.encode("title"))
-                num_tokens += len(encoding.encode(parameters.get("title")))  # type: ignore
-            num_tokens += len(encoding.encode("type"))
-            num_tokens += len(encoding.encode(parameters.get("type")))  # type: ignore
+                num_tokens += key_lens["title"]
+                parts.append(parameters.get("title"))  # type: ignore
+            parts.append(parameters.get("type"))  # type: ignore
             if "properties" in parameters:
-                num_tokens += len(encoding.encode("properties"))
+                num_tokens += key_lens["properties"]
                 for key, value in parameters.get("properties").items():  # type: ignore
-                    num_tokens += len(encoding.encode(key))
+                    parts.append(key)
                     for field_key, field_value in value.items():
-                        num_tokens += len(encoding.encode(field_key))
+                        parts.append(field_key)
                         if field_key == "enum":
                             for enum_field in field_value:
                                 num_tokens += 3
-                                num_tokens += len(encoding.encode(enum_field))
+                                parts.append(enum_field)
                         else:
-                            num_tokens += len(encoding.encode(field_key))
-                            num_tokens += len(encoding.encode(str(field_value)))
+                            parts.append(field_key)
+                            parts.append(str(field_value))
             if "required" in parameters:
-                num_tokens += len(encoding.encode("required"))
+                num_tokens += key_lens["required"]
                 for required_field in parameters["required"]:
                     num_tokens += 3
-                    num_tokens += len(encoding.encode(required_field))
+                    parts.append(required_field)
 
-        return num_tokens
+        return num_tokens + sum(_encode_lengths(encoding, parts))
 
     def get_customizable_model_schema(
         self, model: str, credentials: dict
@@ -1488,15 +2351,15 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
 
         :return: model schema
         """
-        if not model.startswith("ft:"):
-            base_model = model
-        else:
-            # get base_model
-            base_model = model.split(":")[1]
+        # the schema only depends on the model name, callers get a copy they may modify
+        entity = self._customizable_model_schemas.get(model)
+        if entity is not None:
+            return entity.model_copy()
+
+        base_model = _base_model(model)
 
         # get model schema
-        models = self.predefined_models()
-        model_map = {model.model: model for model in models}
+        model_map = self._predefined_model_map
         if base_model not in model_map:
             raise ValueError(f"Base model {base_model} not found")
 
@@ -1516,5 +2379,6 @@ class OpenAILargeLanguageModel(_CommonOpenAI, LargeLanguageModel):
             parameter_rules=list(base_model_schema_parameters_rules),
             pricing=base_model_schema.pricing,
         )
+        self._customizable_model_schemas.put(model, entity)
 
-        return entity
+        return entity.model_copy()
@@ -1,3 +1,5 @@
+import pytest
+
 from dify_plugin.integration.run import (
     PluginRunner,
 )
@@ -10,8 +12,10 @@ from dify_plugin.core.entities.plugin.request import (
     PluginInvokeType,
 )
 from dify_plugin.entities.model import ModelType
-from dify_plugin.entities.model.llm import LLMResultChunk
-from dify_plugin.entities.model.message import UserPromptMessage
+from dify_plugin.entities.model.llm import LLMResultChunk, LLMResultChunkDelta
+from dify_plugin.entities.model.message import AssistantPromptMessage, UserPromptMessage
+
+from models.openai.models.llm.llm import _coalesce_stream, _env_int
 
 
 def test_openai_blocking():
@@ -47,3 +51,46 @@ def test_openai_blocking():
 
 def test_openai_streaming():
     pass
+
+
+def _text_chunks(produced: list, texts: list[str], finish_reason: str = "stop"):
+    for i, text in enumerate(texts):
+        produced.append(text)
+        yield LLMResultChunk(
+            model="gpt-4o",
+            delta=LLMResultChunkDelta(
+                index=0,
+                message=AssistantPromptMessage(content=text),
+                finish_reason=finish_reason if i == len(texts) - 1 else None,
+            ),
+        )
+
+
+def test_openai_streaming_not_coalesced_by_default():
+    produced = []
+    stream = _coalesce_stream(_text_chunks(produced, ["A", "B", "C"]))
+
+    # every delta is forwarded before the next one is read from upstream
+    for expected in ["A", "B", "C"]:
+        assert next(stream).delta.message.content == expected
+        assert produced[-1] == expected
+
+    assert next(stream, None) is None
+
+
+def test_openai_streaming_coalesced_when_enabled():
+    produced = []
+    stream = _coalesce_stream(
+        _text_chunks(produced, ["A", "B", "C", "D", ""]), max_chars=3, max_ms=60_000
+    )
+    chunks = list(stream)
+
+    assert [chunk.delta.message.content for chunk in chunks] == ["ABC", "D", ""]
+    assert [chunk.delta.finish_reason for chunk in chunks] == [None, None, "stop"]
+
+
+@pytest.mark.parametrize("value", ["25ms", "2.5", "off"])
+def test_openai_streaming_malformed_coalesce_window_is_ignored(monkeypatch, value):
+    monkeypatch.setenv("OPENAI_STREAM_COALESCE_MAX_MS", value)
+
+    assert _env_int("OPENAI_STREAM_COALESCE_MAX_MS", 0) == 0
@@ -0,0 +1,163 @@
+from types import SimpleNamespace
+
+import pytest
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+from dify_plugin.entities.model.message import (
+    ImagePromptMessageContent,
+    SystemPromptMessage,
+    TextPromptMessageContent,
+    UserPromptMessage,
+)
+
+from models.openai.models.llm import llm
+from models.openai.models.llm.llm import OpenAILargeLanguageModel
+
+
+class _FakeClient:
+    """
+    Records the requests of the chat completions and responses APIs
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.responses = SimpleNamespace(create=self._responses)
+
+    def _chat(self, **kwargs):
+        self.requests.append(kwargs)
+        return ChatCompletion(
+            id="chatcmpl-1",
+            object="chat.completion",
+            created=0,
+            model=kwargs["model"],
+            choices=[
+                Choice(
+                    index=0,
+                    finish_reason="stop",
+                    message=ChatCompletionMessage(role="assistant", content="ok"),
+                )
+            ],
+            usage=CompletionUsage(
+                prompt_tokens=1, completion_tokens=1, total_tokens=2
+            ),
+        )
+
+    def _responses(self, **kwargs):
+        self.requests.append(kwargs)
+        return SimpleNamespace(
+            output_text="ok",
+            usage=SimpleNamespace(input_tokens=1, output_tokens=1),
+            model=kwargs["model"],
+        )
+
+
+@pytest.fixture
+def client():
+    return _FakeClient()
+
+
+@pytest.fixture
+def model(client, monkeypatch):
+    model = OpenAILargeLanguageModel([])
+    monkeypatch.setattr(model, "_to_credential_kwargs", lambda credentials: {})
+    monkeypatch.setattr(model, "_client_for", lambda credentials_kwargs: client)
+    return model
+
+
+def _chat_generate(model, model_name, prompt_messages):
+    return model._chat_generate(
+        model=model_name,
+        credentials={},
+        prompt_messages=prompt_messages,
+        model_parameters={},
+        stream=False,
+    )
+
+
+def test_mixed_wire_format_and_prompt_messages_are_converted(model, client):
+    _chat_generate(
+        model,
+        "gpt-4o",
+        [
+            {"role": "system", "content": "Be brief."},
+            UserPromptMessage(content="Hello!"),
+        ],
+    )
+
+    assert client.requests[0]["messages"] == [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": "Hello!"},
+    ]
+
+
+def test_o3_pro_input_includes_wire_format_messages(model, client):
+    _chat_generate(
+        model,
+        "o3-pro",
+        [
+            {"role": "system", "content": "Be brief."},
+            {"role": "user", "content": "Hello!"},
+            {"role": "assistant", "content": "Hi."},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "What is"},
+                    {"type": "image_url", "image_url": {"url": "https://a.png"}},
+                    {"type": "text", "text": "this?"},
+                ],
+            },
+        ],
+    )
+
+    assert client.requests[0]["input"] == (
+        "user: Hello!\n\nassistant: Hi.\n\nuser: What is\nthis?"
+    )
+
+
+def test_content_flattening_applies_to_wire_format_messages(model, client):
+    _chat_generate(
+        model,
+        "gpt-4-turbo",
+        [
+            SystemPromptMessage(content="Be brief."),
+            UserPromptMessage(
+                content=[
+                    TextPromptMessageContent(data="Look:"),
+                    ImagePromptMessageContent(
+                        format="png", mime_type="image/png", url="https://a.png"
+                    ),
+                ]
+            ),
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "And this:"},
+                    {"type": "image_url", "image_url": {"url": "https://b.png"}},
+                ],
+            },
+        ],
+    )
+
+    assert client.requests[0]["messages"] == [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": "Look:\n[IMAGE]"},
+        {"role": "user", "content": "And this:\n[IMAGE]"},
+    ]
+
+
+def test_evicted_clients_are_closed(monkeypatch):
+    monkeypatch.setattr(llm._client_cache, "_maxsize", 1)
+    llm._client_cache.clear()
+    model = OpenAILargeLanguageModel([])
+
+    first = model._client_for({"api_key": "first"})
+    assert model._client_for({"api_key": "first"}) is first
+    second = model._client_for({"api_key": "second"})
+
+    assert first.is_closed()
+    assert not second.is_closed()
+    llm._client_cache.clear()
+    assert second.is_closed()
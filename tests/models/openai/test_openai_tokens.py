@@ -0,0 +1,364 @@
+import pytest
+import tiktoken
+from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
+    ChatCompletionMessage,
+    ChatCompletionMessageToolCall,
+)
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import (
+    Choice as ChunkChoice,
+    ChoiceDelta,
+    ChoiceDeltaToolCall,
+    ChoiceDeltaToolCallFunction,
+)
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+from dify_plugin.entities.model.message import (
+    AssistantPromptMessage,
+    ImagePromptMessageContent,
+    PromptMessageTool,
+    SystemPromptMessage,
+    TextPromptMessageContent,
+    ToolPromptMessage,
+    UserPromptMessage,
+)
+
+from models.openai.models.llm import llm
+from models.openai.models.llm.llm import OpenAILargeLanguageModel
+
+
+class _StubEncoding:
+    """
+    One token per character, so every string that is counted shows up in the totals
+    """
+
+    name = "stub"
+
+    def encode(self, text: str, **kwargs) -> list[str]:
+        return list(text)
+
+
+@pytest.fixture
+def model(monkeypatch):
+    OpenAILargeLanguageModel.clear_tokenizer_cache()
+    monkeypatch.setattr(llm, "_get_encoding_for", lambda model: _StubEncoding())
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: _StubEncoding())
+    yield OpenAILargeLanguageModel([])
+    monkeypatch.undo()
+    OpenAILargeLanguageModel.clear_tokenizer_cache()
+
+
+def _reference_num_tokens(model, messages, tools=None) -> int:
+    """
+    Token count as computed before token counting was batched and cached
+    """
+    encoding = _StubEncoding()
+    num_tokens = 0
+    for message in [model._convert_prompt_message_to_dict(m) for m in messages]:
+        num_tokens += 3
+        for key, value in message.items():
+            if isinstance(value, list):
+                value = "".join(
+                    item["text"]
+                    for item in value
+                    if isinstance(item, dict) and item["type"] == "text"
+                )
+            if key != "tool_calls":
+                num_tokens += len(encoding.encode(str(value)))
+            if key == "name":
+                num_tokens += 1
+
+    num_tokens += 3
+    if tools:
+        num_tokens += _reference_num_tokens_for_tools(tools)
+
+    return num_tokens
+
+
+def _reference_num_tokens_for_tools(tools) -> int:
+    def count(text):
+        return len(_StubEncoding().encode(text))
+
+    num_tokens = 0
+    for tool in tools:
+        parameters = tool.parameters
+        num_tokens += count("type") + count("function")
+        num_tokens += count("name") + count(tool.name)
+        num_tokens += count("description") + count(tool.description)
+        num_tokens += count("parameters")
+        if "title" in parameters:
+            num_tokens += count("title") + count(parameters["title"])
+        num_tokens += count("type") + count(parameters["type"])
+        if "properties" in parameters:
+            num_tokens += count("properties")
+            for key, value in parameters["properties"].items():
+                num_tokens += count(key)
+                for field_key, field_value in value.items():
+                    num_tokens += count(field_key)
+                    if field_key == "enum":
+                        for enum_field in field_value:
+                            num_tokens += 3 + count(enum_field)
+                    else:
+                        num_tokens += count(field_key) + count(str(field_value))
+        if "required" in parameters:
+            num_tokens += count("required")
+            for required_field in parameters["required"]:
+                num_tokens += 3 + count(required_field)
+
+    return num_tokens
+
+
+def _tools(n: int) -> list[PromptMessageTool]:
+    return [
+        PromptMessageTool(
+            name=f"tool_{i}",
+            description=f"Tool number {i}",
+            parameters={
+                "type": "object",
+                "title": f"Tool {i}",
+                "properties": {
+                    "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+                    "days": {"type": "integer", "description": "forecast days"},
+                },
+                "required": ["unit"],
+            },
+        )
+        for i in range(n)
+    ]
+
+
+def _tool_call() -> AssistantPromptMessage.ToolCall:
+    return AssistantPromptMessage.ToolCall(
+        id="call_1",
+        type="function",
+        function=AssistantPromptMessage.ToolCall.ToolCallFunction(
+            name="get_weather", arguments='{"city": "Berlin"}'
+        ),
+    )
+
+
+def _chunk(delta: ChoiceDelta, finish_reason=None) -> ChatCompletionChunk:
+    return ChatCompletionChunk(
+        id="chatcmpl-1",
+        object="chat.completion.chunk",
+        created=0,
+        model="gpt-4o",
+        choices=[ChunkChoice(index=0, delta=delta, finish_reason=finish_reason)],
+    )
+
+
+def _tool_call_delta(index: int, **kwargs) -> ChoiceDelta:
+    function = {
+        key: kwargs.pop(key) for key in ("name", "arguments") if key in kwargs
+    }
+    return ChoiceDelta(
+        tool_calls=[
+            ChoiceDeltaToolCall(
+                index=index,
+                function=ChoiceDeltaToolCallFunction(**function),
+                **kwargs,
+            )
+        ]
+    )
+
+
+def test_streamed_and_blocking_completion_tokens_agree(model):
+    tool_call = _tool_call()
+    stream = [
+        _chunk(ChoiceDelta(content="Let me ")),
+        _chunk(ChoiceDelta(content="check.")),
+        _chunk(
+            _tool_call_delta(0, id="call_1", type="function", name="get_weather")
+        ),
+        _chunk(_tool_call_delta(0, arguments='{"city": ')),
+        _chunk(_tool_call_delta(0, arguments='"Berlin"}')),
+        _chunk(ChoiceDelta(), finish_reason="tool_calls"),
+        _chunk(ChoiceDelta(), finish_reason="stop"),
+    ]
+    *_, final_chunk = model._handle_chat_generate_stream_response(
+        "gpt-4o", {}, stream, []
+    )
+
+    blocking_result = model._handle_chat_generate_response(
+        "gpt-4o",
+        {},
+        ChatCompletion(
+            id="chatcmpl-1",
+            object="chat.completion",
+            created=0,
+            model="gpt-4o",
+            choices=[
+                Choice(
+                    index=0,
+                    finish_reason="tool_calls",
+                    message=ChatCompletionMessage(
+                        role="assistant",
+                        content="Let me check.",
+                        tool_calls=[
+                            ChatCompletionMessageToolCall(
+                                id="call_1",
+                                type="function",
+                                function=Function(
+                                    name="get_weather", arguments='{"city": "Berlin"}'
+                                ),
+                            )
+                        ],
+                    ),
+                )
+            ],
+        ),
+        [],
+    )
+
+    # tool calls are flattened away by the message counting, on both paths
+    expected = model._num_tokens_from_messages(
+        "gpt-4o", [AssistantPromptMessage(content="Let me check.", tool_calls=[tool_call])]
+    )
+    assert expected == model._num_tokens_from_messages(
+        "gpt-4o", [AssistantPromptMessage(content="Let me check.")]
+    )
+    assert final_chunk.delta.usage.completion_tokens == expected
+    assert blocking_result.usage.completion_tokens == expected
+
+
+def _conversation() -> list:
+    return [
+        SystemPromptMessage(content="You are a helpful assistant."),
+        UserPromptMessage(content="What is the weather?", name="alice"),
+        AssistantPromptMessage(content="", tool_calls=[_tool_call()]),
+        ToolPromptMessage(content='{"temp": 21}', tool_call_id="call_1"),
+        UserPromptMessage(
+            content=[
+                TextPromptMessageContent(data="And in this picture? "),
+                ImagePromptMessageContent(
+                    format="png", mime_type="image/png", url="https://example.com/a.png"
+                ),
+                TextPromptMessageContent(data="Be brief."),
+            ]
+        ),
+    ]
+
+
+@pytest.mark.parametrize(
+    "messages",
+    [
+        [UserPromptMessage(content="Hello!")],
+        [UserPromptMessage(content="Hello!", name="alice")],
+        [AssistantPromptMessage(content="Sure", tool_calls=[_tool_call()])],
+        _conversation(),
+    ],
+)
+@pytest.mark.parametrize("num_tools", [0, 2, 8, 12])
+def test_num_tokens_from_messages_matches_reference(model, messages, num_tools):
+    tools = _tools(num_tools)
+    expected = _reference_num_tokens(model, messages, tools)
+
+    assert model._num_tokens_from_messages("gpt-4o", messages, tools) == expected
+    # a second count is served from the prefix cache
+    assert model._num_tokens_from_messages("gpt-4o", messages, tools) == expected
+
+
+def test_num_tokens_for_tools_matches_reference(model):
+    tools = _tools(12)
+
+    assert model._num_tokens_for_tools(_StubEncoding(), tools) == (
+        _reference_num_tokens_for_tools(tools)
+    )
+
+
+def test_num_tokens_reuses_counted_prefix(model, monkeypatch):
+    encoded = []
+    encode_lengths = llm._encode_lengths
+
+    def recording_encode_lengths(encoding, parts):
+        encoded.extend(parts)
+        return encode_lengths(encoding, parts)
+
+    monkeypatch.setattr(llm, "_encode_lengths", recording_encode_lengths)
+    messages = _conversation()
+    model._num_tokens_from_messages("gpt-4o", messages[:-1])
+
+    encoded.clear()
+    num_tokens = model._num_tokens_from_messages("gpt-4o", messages)
+
+    assert num_tokens == _reference_num_tokens(model, messages)
+    # only the appended message is encoded
+    assert encoded == ["user", "And in this picture? Be brief."]
+
+
+def test_num_tokens_after_in_place_content_change(model):
+    messages = _conversation()
+    model._num_tokens_from_messages("gpt-4o", messages)
+
+    messages[0].content = "You are a terse assistant, answer in one word."
+
+    assert model._num_tokens_from_messages("gpt-4o", messages) == (
+        _reference_num_tokens(model, messages)
+    )
+
+
+def test_num_tokens_from_string_is_cached(model, monkeypatch):
+    calls = []
+    encoding = _StubEncoding()
+    monkeypatch.setattr(
+        encoding, "encode", lambda text, **kwargs: calls.append(text) or list(text)
+    )
+    monkeypatch.setattr(llm, "_get_encoding_for", lambda model: encoding)
+
+    assert model._num_tokens_from_string("gpt-3.5-turbo-instruct", "Hello!") == 6
+    assert model._num_tokens_from_string("gpt-3.5-turbo-instruct", "Hello!") == 6
+    assert calls == ["Hello!"]
+
+
+def test_streamed_tool_calls_are_aggregated(model):
+    stream = [
+        _chunk(_tool_call_delta(0, id="call_1", type="function", name="get_weather")),
+        _chunk(_tool_call_delta(1, id="call_2", type="function", name="get_time")),
+        _chunk(_tool_call_delta(0, arguments='{"city": ')),
+        _chunk(_tool_call_delta(1, arguments='{"tz": "CET"}')),
+        _chunk(_tool_call_delta(0, arguments='"Berlin"}')),
+        _chunk(ChoiceDelta(), finish_reason="tool_calls"),
+    ]
+    chunks = model._handle_chat_generate_stream_response("gpt-4o", {}, stream, [])
+    tool_calls_chunk = next(
+        chunk for chunk in chunks if chunk.delta.finish_reason == "tool_calls"
+    )
+
+    tool_calls = tool_calls_chunk.delta.message.tool_calls
+    assert [(t.id, t.function.name, t.function.arguments) for t in tool_calls] == [
+        ("call_1", "get_weather", '{"city": "Berlin"}'),
+        ("call_2", "get_time", '{"tz": "CET"}'),
+    ]
+
+
+def test_num_tokens_from_string_does_not_reuse_message_counts(model):
+    message = UserPromptMessage(content="Hello!")
+    model._num_tokens_from_messages("gpt-4o", [message, message])
+
+    # the input a message prefix used to be keyed on, without a domain tag
+    text = "3\x001" + llm._json_dumps(
+        model._convert_prompt_message_to_dict(message), sort_keys=True
+    )
+
+    assert model._num_tokens_from_string("gpt-4o", text) == len(text)
+
+
+def test_num_tokens_prefix_key_ignores_image_payloads(model, monkeypatch):
+    encoded = []
+    encode_lengths = llm._encode_lengths
+
+    def recording_encode_lengths(encoding, parts):
+        encoded.extend(parts)
+        return encode_lengths(encoding, parts)
+
+    monkeypatch.setattr(llm, "_encode_lengths", recording_encode_lengths)
+    messages = _conversation()
+    num_tokens = model._num_tokens_from_messages("gpt-4o", messages)
+
+    encoded.clear()
+    messages[-1].content[1].url = "https://example.com/b.png"
+
+    assert model._num_tokens_from_messages("gpt-4o", messages) == num_tokens
+    assert encoded == []